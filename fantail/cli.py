@@ -5,7 +5,10 @@ setuptools will create a console script pointing to cli:main
 
 import argparse
 import logging
+import os
+import socket
 
+from fantail import daemon
 from fantail.staticsite import StaticSite
 
 def cmd_init_site(args):
@@ -25,9 +28,82 @@ def cmd_clean_site(args):
 def cmd_build_site(args):
     """
     Builds a site by running the generator over the pages directory.
+    If a build daemon is running, the build is handed off to it.
+    """
+    if not args.no_daemon:
+        request = {
+            'cmd': 'build',
+            'site': os.path.abspath(args.site_directory),
+            'debug': args.debug,
+            'generations': args.generations,
+        }
+        try:
+            response = daemon.send_request(args.socket_path, request)
+        except socket.timeout:
+            logging.warning('Daemon on {} did not respond in time, building '
+                            'locally'.format(args.socket_path))
+        except OSError:
+            logging.debug('No daemon on {}, building locally'.format(args.socket_path))
+        except daemon.DaemonException as e:
+            logging.warning('{}; building locally'.format(e))
+        else:
+            daemon.replay_records(response)
+            if not response['ok']:
+                if 'error' in response:
+                    logging.error('Daemon: ' + response['error'])
+                exit(response['exit_code'])
+            return
+
+    site = StaticSite(args.site_directory)
+    site.build_site(generations=args.generations)
+
+def cmd_rollback_site(args):
+    """
+    Points the output directory back at an earlier published generation.
+    Defaults to the generation before the current one.
     """
     site = StaticSite(args.site_directory)
-    site.build_site()
+    site.rollback_site(generation=args.generation)
+
+def cmd_daemon(args):
+    """
+    Runs a build daemon that keeps sites loaded in memory, so that
+    `fantail build` is much faster while it is running.
+    """
+    if args.status:
+        try:
+            response = daemon.send_request(args.socket_path, {'cmd': 'status'})
+        except socket.timeout:
+            logging.error('Daemon on {} did not respond in time'.format(args.socket_path))
+            exit(4)
+        except OSError:
+            logging.error('No daemon is running on ' + args.socket_path)
+            exit(4)
+        except daemon.DaemonException as e:
+            logging.error(str(e))
+            exit(4)
+        logging.info('Daemon (pid {0}) up {1:.0f} seconds with {2} site(s) '
+                     'loaded: {3}'.format(response['pid'], response['uptime'],
+                     len(response['sites']), ', '.join(response['sites'])))
+        return
+
+    try:
+        daemon.run_daemon(args.socket_path)
+    except daemon.DaemonException as e:
+        logging.error(str(e))
+        exit(4)
+
+def positive_int(value):
+    """
+    argparse type for an integer that must be at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be a whole number of at least 1')
+    return number
 
 def parse_args(override_args=None):
     parser = argparse.ArgumentParser(description='fantail is a static site generator')
@@ -38,6 +114,12 @@ def parse_args(override_args=None):
                                  nargs='?', help='Directory where the site is '
                                  'stored. Defaults to %(default)s')
 
+    def add_socket_arg(this_parser):
+        this_parser.add_argument('--socket', dest='socket_path',
+                                 default=daemon.default_socket_path(),
+                                 help='Path of the daemon\'s control socket. '
+                                 'Defaults to %(default)s')
+
     # Common arguments
     parser.add_argument('-d', dest='debug', default=False, action='store_true',
                         help='Switch on verbose logging')
@@ -56,9 +138,31 @@ def parse_args(override_args=None):
 
     # fantail build
     build_parser = subparsers.add_parser('build', description=cmd_build_site.__doc__)
+    build_parser.add_argument('--no-daemon', dest='no_daemon', action='store_true',
+                              help='Build in this process even if a daemon is running')
+    build_parser.add_argument('--generations', dest='generations', type=positive_int,
+                              metavar='K', help='Publish the output as a new '
+                              'generation and keep the last K generations for '
+                              '`fantail rollback`. Once a site has been published '
+                              'this way, defaults to the last K given (or 3)')
+    add_socket_arg(build_parser)
     add_site_arg(build_parser)
     build_parser.set_defaults(func=cmd_build_site)
 
+    # fantail rollback
+    rollback_parser = subparsers.add_parser('rollback', description=cmd_rollback_site.__doc__)
+    rollback_parser.add_argument('--to', dest='generation', type=int, metavar='N',
+                                 help='Generation number to roll back to')
+    add_site_arg(rollback_parser)
+    rollback_parser.set_defaults(func=cmd_rollback_site)
+
+    # fantail daemon
+    daemon_parser = subparsers.add_parser('daemon', description=cmd_daemon.__doc__)
+    daemon_parser.add_argument('--status', dest='status', action='store_true',
+                               help='Show the status of a running daemon and exit')
+    add_socket_arg(daemon_parser)
+    daemon_parser.set_defaults(func=cmd_daemon)
+
     # If no subcommand was given, print help and exit
     if override_args is None:
         args = parser.parse_args()
@@ -0,0 +1,311 @@
+"""
+A persistent build daemon that keeps StaticSite instances warm between builds.
+
+Starting Python, importing Jinja2 and loading plugins dominates the time of
+a small build, so `fantail daemon` does this once and then serves requests
+over a Unix domain socket. Each site requested is loaded once and kept in
+memory along with its compiled templates, up to `MAX_SITES` sites.
+
+The protocol is a single JSON object per connection, terminated by a newline:
+
+    {"cmd": "build", "site": "/abs/path/to/site", "debug": false,
+     "generations": null}
+
+The daemon replies with a single JSON object and closes the connection:
+
+    {"ok": true, "exit_code": 0, "records": [...], ...}
+
+where `records` are the log records emitted while handling the request, so
+the client can replay them as if it had run the command itself.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import time
+
+from fantail.staticsite import StaticSite
+
+COMMANDS = ('build', 'clean', 'status')
+
+# Number of sites kept loaded; the least recently used is dropped after this
+MAX_SITES = 8
+
+# Seconds to wait for a client to send its request, and for the daemon to
+# accept a connection and receive a request
+REQUEST_TIMEOUT = 5
+
+# Seconds to wait for the daemon to reply, which includes running the build
+REPLY_TIMEOUT = 300
+
+class DaemonException(Exception):
+    pass
+
+def _private_dir():
+    # Per-user directory for the socket when there is no XDG_RUNTIME_DIR
+    return os.path.join(tempfile.gettempdir(), 'fantail-{}'.format(os.getuid()))
+
+def default_socket_path():
+    """
+    Returns the socket path to use if none is given: the FANTAIL_SOCKET
+    environment variable if set, otherwise a socket in XDG_RUNTIME_DIR or
+    failing that, a private per-user directory in the system's temporary
+    directory.
+    """
+    path = os.environ.get('FANTAIL_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'fantail.sock')
+    return os.path.join(_private_dir(), 'daemon.sock')
+
+def check_socket_dir(socket_path, create=False):
+    """
+    If `socket_path` is in the private per-user directory, checks that the
+    directory is owned by us and not accessible to anyone else, so another
+    user can't plant a socket there. If `create` is True the directory is
+    created if it doesn't exist. Raises DaemonException if it is unsafe.
+    """
+
+    path = os.path.dirname(socket_path)
+    if path != _private_dir():
+        return
+    if create:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise DaemonException('Refusing to use {}: it must be a directory owned by '
+                              'you with mode 0700'.format(path))
+
+class _RecordCollector(logging.Handler):
+    """
+    Logging handler that stores records so they can be sent to the client.
+    """
+
+    def __init__(self, level):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append({
+            'name': record.name,
+            'levelno': record.levelno,
+            'levelname': record.levelname,
+            'module': record.module,
+            'msg': record.getMessage(),
+        })
+
+def _error_response(error):
+    return {'ok': False, 'exit_code': 1, 'records': [], 'error': error}
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    # Requests are handled one at a time, so don't let an idle client block
+    # everyone else
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            logging.warning('Timed out waiting for a request')
+            return
+        if not line:
+            # Connection was only opened to check we're running
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            response = _error_response('Invalid request: ' + str(e))
+        else:
+            if isinstance(request, dict):
+                response = self.server.dispatch(request)
+            else:
+                response = _error_response('Invalid request: expected a JSON object')
+        try:
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError as e:
+            logging.warning('Could not send reply: {}'.format(e))
+
+class BuildDaemon(socketserver.UnixStreamServer):
+    """
+    Serves build, clean and status requests for any number of sites.
+    Requests are handled one at a time so builds never overlap.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.started = time.time()
+
+        # Absolute site path -> warm StaticSite, least recently used first
+        self.sites = OrderedDict()
+
+        check_socket_dir(socket_path, create=True)
+        self._remove_stale_socket()
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        except OSError as e:
+            raise DaemonException('Cannot listen on {0}: {1}'.format(socket_path, e))
+        logging.info('Listening on ' + socket_path)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        if is_running(self.socket_path):
+            raise DaemonException('A daemon is already listening on ' + self.socket_path)
+        try:
+            os.remove(self.socket_path)
+        except OSError as e:
+            raise DaemonException('Cannot remove stale socket {0}: {1}'.format(
+                self.socket_path, e))
+        logging.debug('Removed stale socket ' + self.socket_path)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def get_site(self, path):
+        """
+        Returns the loaded StaticSite for `path`, loading it if needed. Only
+        sites that exist are kept loaded.
+        """
+        site = self.sites.get(path)
+        if site is not None:
+            self.sites.move_to_end(path)
+            return site
+
+        site = StaticSite(path)
+        site.assert_site_exists()
+        self.sites[path] = site
+        logging.debug('Loaded {} into the daemon'.format(site))
+        if len(self.sites) > MAX_SITES:
+            old_path, old_site = self.sites.popitem(last=False)
+            logging.debug('Unloaded {} from the daemon'.format(old_site))
+        return site
+
+    def dispatch(self, request):
+        """
+        Runs a single request and returns the response to send back.
+        """
+
+        cmd = request.get('cmd')
+        if cmd not in COMMANDS:
+            return _error_response('Unknown command: {}'.format(cmd))
+        if cmd != 'status' and not isinstance(request.get('site'), str):
+            return _error_response('Invalid request: `site` must be a string')
+        generations = request.get('generations')
+        if generations is not None and (not isinstance(generations, int) or
+                                        isinstance(generations, bool)):
+            return _error_response('Invalid request: `generations` must be an '
+                                   'integer or null')
+
+        level = logging.DEBUG if request.get('debug') else logging.INFO
+        collector = _RecordCollector(level)
+        root = logging.getLogger()
+        old_level = root.level
+        old_handler_levels = {}
+        if level < old_level:
+            # Let the client's debug records through to the collector without
+            # them also reaching the daemon's own handlers
+            for handler in root.handlers:
+                old_handler_levels[handler] = handler.level
+                handler.setLevel(max(handler.level, old_level))
+            root.setLevel(level)
+        root.addHandler(collector)
+
+        response = {'ok': True, 'exit_code': 0}
+        start = time.time()
+        try:
+            if cmd == 'status':
+                response['pid'] = os.getpid()
+                response['uptime'] = time.time() - self.started
+                response['sites'] = sorted(self.sites)
+            else:
+                site = self.get_site(os.path.abspath(request['site']))
+                if cmd == 'build':
+                    site.build_site(generations=generations)
+                else:
+                    site.clean_site()
+        except SystemExit as e:
+            # StaticSite exits on user errors; report them instead of dying
+            response['ok'] = False
+            response['exit_code'] = e.code
+        except Exception as e:
+            logging.exception('Error handling `{}` request'.format(cmd))
+            response['ok'] = False
+            response['exit_code'] = 1
+            response['error'] = str(e)
+        finally:
+            root.removeHandler(collector)
+            root.setLevel(old_level)
+            for handler, handler_level in old_handler_levels.items():
+                handler.setLevel(handler_level)
+
+        logging.debug('Handled `{0}` request in {1:.1f} ms'.format(
+            cmd, (time.time() - start) * 1000))
+        response['records'] = collector.records
+        return response
+
+def send_request(socket_path, request, reply_timeout=None):
+    """
+    Sends a request to the daemon listening on `socket_path` and returns its
+    response, waiting up to `reply_timeout` seconds (default REPLY_TIMEOUT)
+    for it. Raises OSError (including socket.timeout) if the daemon can't be
+    reached or doesn't reply in time, or DaemonException if the socket's
+    directory is unsafe.
+    """
+    check_socket_dir(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(REQUEST_TIMEOUT)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        sock.settimeout(REPLY_TIMEOUT if reply_timeout is None else reply_timeout)
+        with sock.makefile('rb') as fp:
+            line = fp.readline()
+    if not line:
+        raise ConnectionError('Daemon closed the connection without replying')
+    return json.loads(line.decode('utf-8'))
+
+def is_running(socket_path):
+    """
+    Returns True if a daemon is accepting connections on `socket_path`.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(REQUEST_TIMEOUT)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+def replay_records(response):
+    """
+    Emits the log records in a daemon response through the local logging
+    configuration, as if the command had been run in this process.
+    """
+    for r in response.get('records', []):
+        logging.getLogger(r['name']).handle(logging.makeLogRecord(r))
+
+def run_daemon(socket_path):
+    """
+    Runs the daemon in the foreground until interrupted.
+    """
+    server = BuildDaemon(socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Shutting down')
+    finally:
+        server.server_close()
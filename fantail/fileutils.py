@@ -100,3 +100,38 @@ def map_input_output_files(input_dir):
             output_pages[input_filename] = output_filename
 
     return output_pages
+
+def write_file(path, text, link_from=None):
+    """
+    Writes `text` to `path`. If `link_from` is given and is a file with exactly
+    the contents that would be written, `path` is instead created as a hard
+    link to it, so the unchanged content is never written again. Both paths
+    must be on the same filesystem. Returns True if the file was linked.
+    """
+
+    if link_from is not None and os.path.isfile(link_from):
+        # Compare with what text mode would write, newline translation included
+        try:
+            with open(link_from, 'r', newline='') as fp:
+                same = fp.read() == text.replace('\n', os.linesep)
+        except UnicodeDecodeError:
+            same = False
+        if same:
+            os.link(link_from, path)
+            return True
+
+    with open(path, 'w') as fp:
+        fp.write(text)
+    return False
+
+def replace_symlink(target, link_name):
+    """
+    Atomically points the symlink `link_name` at `target`, creating it if
+    it doesn't exist. Readers of `link_name` will see either the old or new
+    target, never a missing path.
+    """
+    temp_link = link_name + '.new'
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(target, temp_link)
+    os.replace(temp_link, link_name)
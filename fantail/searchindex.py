@@ -0,0 +1,228 @@
+"""
+Client-side search index generation.
+
+The index is an inverted index of every term in the site's pages, written
+as a set of small JSON files under `search/` in the output directory so a
+client only needs to download the shards for the terms it is looking up:
+
+/output/search
+* index.json -> manifest: document table and list of shards
+* /terms
+   * ab.json -> {"abc": [0, 3, 1], "abs": [2], ...}
+   * _c3a974.json -> {"été": [4], ...}
+   * ...
+
+Terms are sharded by their first `PREFIX_LENGTH` characters. A prefix of
+ASCII letters and digits is used as the shard name as is; any other prefix
+is UTF-8 encoded and written as hex after an underscore. Each term maps
+to a sorted list of document ids that is delta-encoded: the first element
+is the first document id, and each following element is the difference from
+the previous one. A client recovers the ids with a running sum.
+
+Tokenising a page is the expensive part, so the terms of each page are
+cached (keyed on a digest of its content) between builds and only pages
+that have changed are re-tokenised.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+from fantail.fileutils import write_file
+
+# Bump this if the cache or output format changes
+INDEX_VERSION = 2
+
+# Number of leading characters of a term used to pick its shard
+PREFIX_LENGTH = 2
+
+_tag_re = re.compile(r'<[^>]*>')
+_entity_re = re.compile(r'&#?\w+;')
+_word_re = re.compile(r'[^\W_]+')
+_shard_re = re.compile(r'^[a-z0-9]+$')
+
+def tokenize(text):
+    """
+    Returns the set of searchable terms in `text`. HTML tags and entities
+    are stripped, terms are lowercased and any term shorter than
+    `PREFIX_LENGTH` characters is ignored.
+    """
+    text = _entity_re.sub(' ', _tag_re.sub(' ', text))
+    return {w for w in _word_re.findall(text.lower()) if len(w) >= PREFIX_LENGTH}
+
+def delta_encode(ids):
+    """
+    Delta-encodes a sorted list of integers.
+    """
+    encoded = []
+    prev = 0
+    for i in ids:
+        encoded.append(i - prev)
+        prev = i
+    return encoded
+
+def delta_decode(deltas):
+    """
+    Reverses delta_encode().
+    """
+    ids = []
+    total = 0
+    for d in deltas:
+        total += d
+        ids.append(total)
+    return ids
+
+def shard_name(term):
+    """
+    Returns the name of the shard `term` is stored in.
+    """
+    prefix = term[:PREFIX_LENGTH]
+    if _shard_re.match(prefix):
+        return prefix
+    # Prefixes can't otherwise start with an underscore, so this can't clash
+    return '_' + prefix.encode('utf-8').hex()
+
+class SearchIndex(object):
+    """
+    An inverted index of the pages in a site, built up one page at a time
+    by add_page() during generation.
+    """
+
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+
+        # url -> {id, digest, title, terms} from the previous build
+        self._cached = {}
+        # url -> {id, digest, title, terms} for this build
+        self._docs = {}
+        # Highest document id handed out so far, or -1 if none
+        self._max_id = -1
+
+        self._load_cache()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_filename, 'r') as fp:
+                cache = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.warning('Ignoring corrupt search index cache ' + self.cache_filename)
+            return
+
+        if cache.get('version') != INDEX_VERSION:
+            logging.debug('Search index cache is an old version, rebuilding')
+            return
+        self._cached = cache['docs']
+        self._max_id = cache['max_id']
+        logging.debug('Loaded {} cached search index entries'.format(len(self._cached)))
+
+    def reset(self):
+        """
+        Discards pages added since the last save_cache(), e.g. from a build
+        that failed part way through.
+        """
+        self._docs = {}
+
+    def add_page(self, url, headers, content):
+        """
+        Adds a page to the index. `headers` and `content` are as returned by
+        StaticSite._render_page(), i.e. after filters have been applied.
+        """
+
+        # Headers are case-insensitive, as in email.message.Message
+        if hasattr(headers, 'items'):
+            headers = headers.items()
+        title = next((v for k, v in headers if k.lower() == 'title'), '')
+        digest = hashlib.sha1((title + '\0' + content).encode('utf-8')).hexdigest()
+
+        cached = self._cached.get(url)
+        if cached is not None and cached['digest'] == digest:
+            terms = cached['terms']
+        else:
+            terms = sorted(tokenize(title) | tokenize(content))
+            logging.debug('Indexed {0} terms from {1}'.format(len(terms), url))
+
+        # Unchanged pages keep their id from previous builds
+        if cached is not None:
+            doc_id = cached['id']
+        else:
+            self._max_id += 1
+            doc_id = self._max_id
+        self._docs[url] = {
+            'id': doc_id,
+            'digest': digest,
+            'title': title,
+            'terms': terms,
+        }
+
+    def shards(self):
+        """
+        Returns a dictionary of shard name -> {term: delta-encoded postings}.
+        """
+        postings = {}
+        for doc in self._docs.values():
+            for term in doc['terms']:
+                postings.setdefault(term, []).append(doc['id'])
+
+        shards = {}
+        for term, ids in postings.items():
+            shards.setdefault(shard_name(term), {})[term] = delta_encode(sorted(ids))
+        return shards
+
+    def write(self, output_dir, previous_dir=None):
+        """
+        Writes the manifest and term shards to `search/` under `output_dir`.
+        If `previous_dir` is given, files identical to the same file in it
+        are hard linked instead of written.
+        """
+
+        def write_json(relative_path, obj):
+            previous = None
+            if previous_dir is not None:
+                previous = os.path.join(previous_dir, relative_path)
+            write_file(os.path.join(output_dir, relative_path),
+                       json.dumps(obj, sort_keys=True, separators=(',', ':')),
+                       previous)
+
+        search_dir = os.path.join(output_dir, 'search')
+        os.makedirs(os.path.join(search_dir, 'terms'), exist_ok=True)
+
+        shards = self.shards()
+        for name, terms in shards.items():
+            write_json(os.path.join('search', 'terms', name + '.json'), terms)
+
+        docs = {str(d['id']): {'url': url, 'title': d['title']}
+                for url, d in self._docs.items()}
+        manifest = {
+            'version': INDEX_VERSION,
+            'prefix_length': PREFIX_LENGTH,
+            'docs': docs,
+            'shards': sorted(shards),
+        }
+        write_json(os.path.join('search', 'index.json'), manifest)
+
+        logging.debug('Wrote search index of {0} pages in {1} shards to {2}'.format(
+            len(self._docs), len(shards), search_dir))
+
+    def save_cache(self):
+        """
+        Persists the terms of each page so the next build only needs to
+        re-index pages that have changed. Pages not seen in this build
+        are dropped, but their ids are never handed out again.
+        """
+        os.makedirs(os.path.dirname(self.cache_filename), exist_ok=True)
+        cache = {
+            'version': INDEX_VERSION,
+            'max_id': self._max_id,
+            'docs': self._docs,
+        }
+        with open(self.cache_filename, 'w') as fp:
+            json.dump(cache, fp, separators=(',', ':'))
+        self._cached = self._docs
+        self._docs = {}
@@ -5,11 +5,12 @@ from jinja2.exceptions import TemplateNotFound
 import os
 import shutil
 import subprocess
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 
 from fantail import __version__
 from fantail.plugins.registry import load_plugins
 from fantail.fileutils import *
+from fantail.searchindex import SearchIndex
 
 class StaticSite(object):
     """
@@ -25,12 +26,22 @@ class StaticSite(object):
     # Base template to use if no template: header is specified in a page
     base_template_name = 'base.html'
 
+    # Number of generations to keep when publishing if not given
+    default_generations = 3
+
     # System context to add to each template
     _system_context = {'version': __version__}
 
     # Plugins registered by load_plugins()
     plugins = None
 
+    # Jinja2 environment, created on first use so compiled templates are
+    # kept between builds of the same instance
+    _template_env = None
+
+    # SearchIndex, likewise kept so its page cache isn't reloaded each build
+    _search_index = None
+
     def __init__(self, env_dir):
         # Absolute path of this environment
         self.path = os.path.abspath(env_dir)
@@ -53,6 +64,28 @@ class StaticSite(object):
     def output_dir(self):
         return os.path.join(self.path, 'output')
 
+    @property
+    def generations_dir(self):
+        return os.path.join(self.path, 'generations')
+
+    @property
+    def cache_dir(self):
+        return os.path.join(self.path, '.cache')
+
+    @property
+    def template_env(self):
+        if self._template_env is None:
+            loader = FileSystemLoader(self.template_dir)
+            # auto_reload (the default) recompiles templates changed on disk
+            self._template_env = Environment(loader=loader, auto_reload=True)
+        return self._template_env
+
+    @property
+    def search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(os.path.join(self.cache_dir, 'search.json'))
+        return self._search_index
+
     def assert_site_exists(self):
         if not os.path.isdir(self.path):
             logging.error('Site at ' + self.path + ' does not exist. '
@@ -86,14 +119,24 @@ class StaticSite(object):
         logging.debug('Created output directory at ' + self.output_dir)
         logging.info('Created new site at ' + self.path)
 
-    def build_site(self):
+    def build_site(self, generations=None):
         """
         Builds the site and writes output only if the build is successful.
         It is safe to call this over and over.
+
+        If `generations` is given, or the output directory is already a
+        symlink from a previous call with it, the site is published as a
+        new generation and the last `generations` generations are kept.
+        The number is remembered for later builds that don't give it.
+        See _publish_generation().
         """
 
         self.assert_site_exists()
 
+        if generations is not None and generations < 1:
+            logging.error('Number of generations to keep must be at least 1.')
+            exit(2)
+
         page_map = map_input_output_files(self.pages_dir)
         if len(page_map) == 0:
             logging.warning('No pages to generate from ' + self.pages_dir)
@@ -101,20 +144,93 @@ class StaticSite(object):
             logging.debug('Will generate the following pages from {0}: {1}'.format(
                 self.pages_dir, str(page_map)))
 
-        self._write_output(page_map)
+        # Once published as generations, output must never be written to in
+        # place as its files are hard linked into older generations
+        if generations is None and os.path.islink(self.output_dir):
+            generations = self.saved_generations()
+        if generations is not None:
+            self._publish_generation(page_map, generations)
+        else:
+            self._write_output(page_map)
 
     def clean_site(self):
         """
-        Cleans the site by removing the output directory only.
-        Does not delete any pages or templates.
+        Cleans the site by removing the output directory (and any published
+        generations) only. Does not delete any pages or templates.
         """
         self.assert_site_exists()
-        if os.path.isdir(self.output_dir):
+        if os.path.islink(self.output_dir):
+            os.remove(self.output_dir)
+            shutil.rmtree(self.generations_dir, ignore_errors=True)
+            logging.info('Removed output directory and generations from ' + self.path)
+        elif os.path.isdir(self.output_dir):
             logging.info('Removed output directory from ' + self.path)
             shutil.rmtree(self.output_dir)
         else:
             logging.info('Nothing to do.')
 
+    def list_generations(self):
+        """
+        Returns a sorted list of the generation numbers that exist on disk.
+        """
+        if not os.path.isdir(self.generations_dir):
+            return []
+        return sorted(int(d) for d in os.listdir(self.generations_dir) if d.isdigit())
+
+    def saved_generations(self):
+        """
+        Returns the number of generations to keep as last given to
+        build_site(), or `default_generations` if it was never given.
+        """
+        try:
+            with open(self._generations_keep_file, 'r') as fp:
+                return max(int(fp.read()), 1)
+        except (FileNotFoundError, ValueError):
+            return self.default_generations
+
+    @property
+    def _generations_keep_file(self):
+        return os.path.join(self.generations_dir, 'keep')
+
+    def current_generation(self):
+        """
+        Returns the generation number the output directory points to, or
+        None if the output directory is not a generation.
+        """
+        if not os.path.islink(self.output_dir):
+            return None
+        name = os.path.basename(os.readlink(self.output_dir))
+        return int(name) if name.isdigit() else None
+
+    def rollback_site(self, generation=None):
+        """
+        Points the output directory back at an earlier generation: the one
+        before the current generation, or `generation` if given.
+        """
+
+        self.assert_site_exists()
+
+        current = self.current_generation()
+        if current is None:
+            logging.error('Site at ' + self.path + ' has no published generations.')
+            exit(2)
+
+        available = self.list_generations()
+        if generation is None:
+            older = [g for g in available if g < current]
+            if len(older) == 0:
+                logging.error('No generation older than {} to roll back to.'.format(current))
+                exit(2)
+            generation = older[-1]
+        elif generation not in available:
+            logging.error('Generation {0} does not exist. Available generations: '
+                          '{1}'.format(generation, ', '.join(map(str, available))))
+            exit(2)
+
+        replace_symlink(self._generation_target(generation), self.output_dir)
+        logging.info('Rolled back output from generation {0} to {1}'.format(
+            current, generation))
+
     def _render_page(self, input_filename, output_filename):
         # Parse the entry
         with open(input_filename, 'r') as fp:
@@ -139,14 +255,17 @@ class StaticSite(object):
         with open(input_filename, 'r') as fp:
             return fp.read()
 
-    def _generate_pages(self, page_map, output_dir):
+    def _generate_pages(self, page_map, output_dir, search_index=None,
+                        previous_dir=None):
         """
         Takes a page map as returned by map_pages() and generates each page
-        using the templates loaded with Jinja2.
+        using the templates loaded with Jinja2. If `search_index` is given,
+        each page's headers and filtered content are added to it. If
+        `previous_dir` is given, pages identical to the same page in it are
+        hard linked instead of written.
         """
 
-        loader = FileSystemLoader(self.template_dir)
-        env = Environment(loader=loader)
+        env = self.template_env
 
         for input_filename, output_filename in page_map.items():
             # Join the full path name and create intermediate output dirs
@@ -160,6 +279,9 @@ class StaticSite(object):
 
             if input_filename.endswith('.txt'):
                 template_name, headers, output = self._render_page(input_filename, path)
+                if search_index is not None:
+                    url = '/' + output_filename[:-len('index.html')]
+                    search_index.add_page(url, headers, output)
             else:
                 output = self._render_static(input_filename, path)
                 template_name = None # no template, will render content only
@@ -183,22 +305,121 @@ class StaticSite(object):
             else:
                 template = Template('{{ content }}')
 
-            with open(path, 'w') as fp:
-                fp.write(template.render(context))
-                fp.write(os.linesep)
-            logging.debug('Wrote {0} from {1}'.format(path, input_filename))
+            previous = None
+            if previous_dir is not None:
+                previous = os.path.join(previous_dir, output_filename)
+            if write_file(path, template.render(context) + os.linesep, previous):
+                logging.debug('Linked {0} unchanged from {1}'.format(path, previous))
+            else:
+                logging.debug('Wrote {0} from {1}'.format(path, input_filename))
 
     def _write_output(self, page_map):
         """
         Generate the output pages to a temporary directory so not
         to trample over any existing pages if there is a failure.
         """
+        search_index = self.search_index
+        search_index.reset()
         with TemporaryDirectory() as temp_dir:
-            self._generate_pages(page_map, temp_dir)
+            self._generate_pages(page_map, temp_dir, search_index)
+            search_index.write(temp_dir)
             # If we get here without an exception, the full site was generated
             # successfully, so move the output files over from the temporary
             mirror_tree(temp_dir, self.output_dir, exclude=['.git'])
+        search_index.save_cache()
+
+        self._log_finished()
 
+    def _generation_target(self, generation):
+        # Relative so the site directory can be moved
+        return os.path.join(os.path.basename(self.generations_dir), str(generation))
+
+    def _publish_generation(self, page_map, keep):
+        """
+        Generate the output pages to a new generation directory, hard linking
+        any files unchanged from the current generation rather than writing
+        them again, and then atomically
+        point the output symlink at it. A reader of the output directory
+        will only ever see a complete generation.
+        """
+
+        # A git checkout in the output directory can't be carried between
+        # generations, and would be lost when its generation is pruned
+        if os.path.exists(os.path.join(self.output_dir, '.git')):
+            logging.error('Cannot publish generations: {} is a git checkout. '
+                          'Build without --generations instead.'.format(self.output_dir))
+            exit(2)
+
+        created_generations_dir = not os.path.isdir(self.generations_dir)
+        os.makedirs(self.generations_dir, exist_ok=True)
+        existing = self.list_generations()
+        generation = existing[-1] + 1 if existing else 1
+
+        # The first publish moves a plain output directory into place as
+        # the previous generation so it can be rolled back to
+        migrate = os.path.isdir(self.output_dir) and not os.path.islink(self.output_dir)
+        if migrate:
+            previous_dir = self.output_dir
+            migrated_generation = generation
+            generation += 1
+        else:
+            current = self.current_generation()
+            previous_dir = None if current is None else \
+                os.path.join(self.generations_dir, str(current))
+
+        search_index = self.search_index
+        search_index.reset()
+
+        # Build within the generations directory so it can be renamed into place
+        build_dir = mkdtemp(prefix='.build-', dir=self.generations_dir)
+        try:
+            os.chmod(build_dir, 0o755)
+            self._generate_pages(page_map, build_dir, search_index, previous_dir)
+            search_index.write(build_dir, previous_dir)
+            generation_dir = os.path.join(self.generations_dir, str(generation))
+            os.rename(build_dir, generation_dir)
+        except BaseException:
+            if created_generations_dir:
+                shutil.rmtree(self.generations_dir, ignore_errors=True)
+            else:
+                shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        search_index.save_cache()
+
+        target = self._generation_target(generation)
+        if migrate:
+            # A directory can't be atomically replaced by a symlink, so this
+            # one-time step leaves output missing between the two renames.
+            # Create the symlink first to keep that as short as possible.
+            temp_link = self.output_dir + '.new'
+            if os.path.lexists(temp_link):
+                os.remove(temp_link)
+            os.symlink(target, temp_link)
+            os.rename(self.output_dir, os.path.join(self.generations_dir,
+                                                    str(migrated_generation)))
+            os.replace(temp_link, self.output_dir)
+        else:
+            replace_symlink(target, self.output_dir)
+        with open(self._generations_keep_file, 'w') as fp:
+            fp.write(str(keep) + os.linesep)
+        logging.debug('Published generation {0} to {1}'.format(generation, self.output_dir))
+
+        self._prune_generations(keep)
+        self._log_finished()
+
+    def _prune_generations(self, keep):
+        """
+        Removes all but the newest `keep` generations. The current generation
+        is never removed, even if it has been rolled back to.
+        """
+        current = self.current_generation()
+        for generation in self.list_generations()[:-keep]:
+            if generation == current:
+                continue
+            shutil.rmtree(os.path.join(self.generations_dir, str(generation)))
+            logging.debug('Removed old generation {}'.format(generation))
+
+    def _log_finished(self):
         p = subprocess.run(['tree', self.output_dir], check=True,
                        stdout=subprocess.PIPE)
         logging.info('Finished. Output directory: ' + p.stdout.decode('utf-8'))
@@ -4,11 +4,20 @@ This does not test the functionality, merely the interface in cli.py.
 See `test_staticsite.py` for functionality tests.
 """
 
+import os
 from os import linesep
 import pytest
 
 from fantail.cli import main as fantail_main
 
+@pytest.fixture(autouse=True)
+def no_daemon(tmpdir, monkeypatch):
+    """
+    Make sure `fantail build` never talks to a daemon on the machine running
+    the tests.
+    """
+    monkeypatch.setenv('FANTAIL_SOCKET', str(tmpdir.join('no-daemon.sock')))
+
 def test_cli_noargs(capsys):
     """
     $ fantail
@@ -69,3 +78,36 @@ def test_cli_clean_site_does_not_exist(tmpdir, caplog):
     with pytest.raises(SystemExit):
         fantail_main(args) # fails
     assert 'Site at ' + path + ' does not exist.' in caplog.text()
+
+def test_cli_daemon_status_not_running(tmpdir):
+    """
+    $ fantail daemon --status
+    """
+    path = str(tmpdir.join('fantail.sock'))
+    args = ['daemon', '--status', '--socket', path]
+    with pytest.raises(SystemExit):
+        fantail_main(args) # fails
+
+def test_cli_build_without_daemon(tmpdir, monkeypatch):
+    """
+    $ fantail init
+    $ fantail build
+    """
+    from fantail.staticsite import StaticSite
+    monkeypatch.setattr(StaticSite, '_log_finished', lambda self: None)
+
+    path = str(tmpdir.join('test-site'))
+    fantail_main(['init', path])
+    with open(os.path.join(path, 'pages', 'index.txt'), 'w') as fp:
+        fp.write('title: Home' + linesep + linesep + 'Hello' + linesep)
+    fantail_main(['build', path]) # builds locally
+    assert os.path.isfile(os.path.join(path, 'output', 'index.html'))
+
+def test_cli_build_invalid_generations(tmpdir):
+    """
+    $ fantail build --generations 0
+    """
+    path = str(tmpdir.join('test-site'))
+    for value in ('0', '-2', 'foo'):
+        with pytest.raises(SystemExit):
+            fantail_main(['build', '--generations', value, path])
@@ -0,0 +1,262 @@
+"""
+Tests for daemon.py - the persistent build daemon
+"""
+
+import json
+import logging
+import os.path
+import socket
+import threading
+import time
+import pytest
+
+from fantail import daemon
+from fantail.cli import main as fantail_main
+from fantail.daemon import *
+from fantail.staticsite import StaticSite
+
+@pytest.fixture
+def build_daemon(tmpdir):
+    server = BuildDaemon(str(tmpdir.join('fantail.sock')))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def test_not_running(tmpdir):
+    path = str(tmpdir.join('fantail.sock'))
+    assert not is_running(path)
+    with pytest.raises(OSError):
+        send_request(path, {'cmd': 'status'})
+
+def test_default_socket_path(monkeypatch):
+    monkeypatch.setenv('FANTAIL_SOCKET', '/tmp/test.sock')
+    assert default_socket_path() == '/tmp/test.sock'
+    monkeypatch.delenv('FANTAIL_SOCKET')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert default_socket_path() == '/run/user/1000/fantail.sock'
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert default_socket_path() == os.path.join(daemon._private_dir(), 'daemon.sock')
+
+def test_private_socket_dir(tmpdir, monkeypatch):
+    private_dir = tmpdir.join('fantail-private')
+    monkeypatch.setattr(daemon, '_private_dir', lambda: str(private_dir))
+    path = str(private_dir.join('daemon.sock'))
+
+    # Created with mode 0700 by the daemon
+    server = BuildDaemon(path)
+    server.server_close()
+    assert os.stat(str(private_dir)).st_mode & 0o777 == 0o700
+
+    # Refuse to use it if anyone else can write to it
+    private_dir.chmod(0o777)
+    with pytest.raises(DaemonException):
+        BuildDaemon(path)
+    with pytest.raises(DaemonException):
+        send_request(path, {'cmd': 'status'})
+
+def test_stale_socket_not_removable(tmpdir):
+    socket_dir = tmpdir.mkdir('sockets')
+    path = str(socket_dir.join('fantail.sock'))
+    open(path, 'w').close()
+    socket_dir.chmod(0o500)
+    try:
+        if os.access(str(socket_dir), os.W_OK):
+            pytest.skip('Directory permissions are not enforced (running as root?)')
+        with pytest.raises(DaemonException):
+            BuildDaemon(path)
+    finally:
+        socket_dir.chmod(0o700)
+
+def test_status(build_daemon):
+    assert is_running(build_daemon.socket_path)
+    response = send_request(build_daemon.socket_path, {'cmd': 'status'})
+    assert response['ok']
+    assert response['pid'] == os.getpid()
+    assert response['sites'] == []
+
+def test_already_running(build_daemon):
+    with pytest.raises(DaemonException):
+        BuildDaemon(build_daemon.socket_path)
+
+def test_stale_socket(tmpdir):
+    path = str(tmpdir.join('fantail.sock'))
+    open(path, 'w').close()
+    server = BuildDaemon(path)
+    server.server_close()
+    assert not os.path.exists(path)
+
+def test_unknown_command(build_daemon):
+    response = send_request(build_daemon.socket_path, {'cmd': 'foo'})
+    assert not response['ok']
+    assert response['error'] == 'Unknown command: foo'
+
+def test_build_site_does_not_exist(build_daemon, tmpdir):
+    path = str(tmpdir.join('test-site'))
+    response = send_request(build_daemon.socket_path, {'cmd': 'build', 'site': path})
+    assert not response['ok']
+    assert response['exit_code'] == 2
+    messages = [r['msg'] for r in response['records']]
+    assert 'Site at ' + path + ' does not exist. Please run `fantail init` first.' in messages
+
+    # Sites that don't exist aren't kept loaded
+    response = send_request(build_daemon.socket_path, {'cmd': 'status'})
+    assert response['sites'] == []
+
+def test_site_cache_is_bounded(build_daemon, tmpdir, monkeypatch):
+    monkeypatch.setattr(daemon, 'MAX_SITES', 2)
+    paths = []
+    for i in range(3):
+        site = StaticSite(str(tmpdir.join('site-{}'.format(i))))
+        site.init_site()
+        paths.append(site.path)
+        build_daemon.get_site(site.path)
+    assert list(build_daemon.sites) == paths[1:]
+
+    # Using a site makes it the most recently used
+    build_daemon.get_site(paths[1])
+    assert list(build_daemon.sites) == [paths[2], paths[1]]
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def test_replay_records():
+    handler = _ListHandler()
+    logging.getLogger().addHandler(handler)
+    try:
+        replay_records({'records': [{
+            'name': 'fantail.test',
+            'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'module': 'staticsite',
+            'msg': 'Replayed from the daemon',
+        }]})
+    finally:
+        logging.getLogger().removeHandler(handler)
+    assert len(handler.records) == 1
+    record = handler.records[0]
+    assert record.getMessage() == 'Replayed from the daemon'
+    assert record.module == 'staticsite'
+    assert record.levelno == logging.WARNING
+
+def test_debug_request_keeps_daemon_handler_level(build_daemon):
+    handler = _ListHandler()
+    root = logging.getLogger()
+    old_level = root.level
+    root.setLevel(logging.INFO)
+    root.addHandler(handler)
+    try:
+        response = send_request(build_daemon.socket_path,
+                                {'cmd': 'build', 'site': '/nonexistent', 'debug': True})
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(old_level)
+
+    # The client gets the debug records, but the daemon's handlers don't
+    assert any(r['levelno'] == logging.DEBUG for r in response['records'])
+    assert not any(r.levelno == logging.DEBUG for r in handler.records)
+    assert handler.level == logging.NOTSET
+
+def test_build_through_daemon(build_daemon, tmpdir, monkeypatch):
+    """
+    $ fantail daemon
+    $ fantail build
+    $ fantail build
+    """
+    monkeypatch.setattr(StaticSite, '_log_finished',
+                        lambda self: logging.info('Finished building ' + self.path))
+    responses = []
+    def spy_replay_records(response):
+        responses.append(response)
+    monkeypatch.setattr(daemon, 'replay_records', spy_replay_records)
+
+    path = str(tmpdir.join('test-site'))
+    fantail_main(['init', path])
+    with open(os.path.join(path, 'pages', 'index.txt'), 'w') as fp:
+        fp.write('title: Home\n\nHello\n')
+
+    args = ['build', '--socket', build_daemon.socket_path, path]
+    fantail_main(args)
+    assert os.path.isfile(os.path.join(path, 'output', 'index.html'))
+
+    # The build ran in the daemon and its log was sent back to replay
+    assert list(build_daemon.sites) == [path]
+    assert len(responses) == 1
+    assert responses[0]['ok']
+    assert 'Finished building ' + path in [r['msg'] for r in responses[0]['records']]
+
+    # A second build reuses the warm site
+    site = build_daemon.sites[path]
+    template_env = site.template_env
+    search_index = site.search_index
+    fantail_main(args)
+    assert len(responses) == 2
+    assert build_daemon.sites[path] is site
+    assert site.template_env is template_env
+    assert site.search_index is search_index
+
+def test_idle_client_does_not_block(build_daemon, monkeypatch):
+    monkeypatch.setattr(daemon._RequestHandler, 'timeout', 0.2)
+
+    # Connect but never send a request
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+        idle.connect(build_daemon.socket_path)
+        start = time.time()
+        response = send_request(build_daemon.socket_path, {'cmd': 'status'},
+                                reply_timeout=5)
+        assert response['ok']
+        assert time.time() - start < 5
+
+def test_daemon_does_not_reply(tmpdir, monkeypatch):
+    """
+    $ fantail build    # with a daemon that never replies
+    """
+    monkeypatch.setattr(StaticSite, '_log_finished', lambda self: None)
+    monkeypatch.setattr(daemon, 'REPLY_TIMEOUT', 0.2)
+
+    path = str(tmpdir.join('test-site'))
+    fantail_main(['init', path])
+    socket_path = str(tmpdir.join('fantail.sock'))
+
+    # Accepts connections but never reads or replies to them
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stuck:
+        stuck.bind(socket_path)
+        stuck.listen(1)
+        with pytest.raises(socket.timeout):
+            send_request(socket_path, {'cmd': 'status'})
+
+        # The build falls back to running locally
+        fantail_main(['build', '--socket', socket_path, path])
+    assert os.path.isdir(os.path.join(path, 'output', 'search'))
+
+def send_raw(socket_path, data):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(data + b'\n')
+        with sock.makefile('rb') as fp:
+            return json.loads(fp.readline().decode('utf-8'))
+
+def test_invalid_requests(build_daemon):
+    for data in (b'not json', b'[]', b'"build"', b'42', b'null'):
+        response = send_raw(build_daemon.socket_path, data)
+        assert not response['ok']
+        assert response['error'].startswith('Invalid request')
+
+    for request in ({'cmd': 'build'},
+                    {'cmd': 'build', 'site': ['/tmp']},
+                    {'cmd': 'clean', 'site': 42},
+                    {'cmd': 'build', 'site': '/tmp', 'generations': '0'},
+                    {'cmd': 'build', 'site': '/tmp', 'generations': True},
+                    {'cmd': 'build', 'site': '/tmp', 'generations': 1.5}):
+        response = send_request(build_daemon.socket_path, request)
+        assert not response['ok']
+        assert response['error'].startswith('Invalid request')
+    assert build_daemon.sites == {}
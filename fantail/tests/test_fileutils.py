@@ -0,0 +1,40 @@
+"""
+Tests for fileutils.py - file-related utility functions
+"""
+
+import os
+
+from fantail.fileutils import *
+
+def test_write_file(tmpdir):
+    prev = tmpdir.mkdir('prev')
+    dest = tmpdir.mkdir('dest')
+    prev.join('same.html').write('same\n')
+    prev.join('changed.html').write('old\n')
+
+    # Identical content is linked
+    assert write_file(str(dest.join('same.html')), 'same\n', str(prev.join('same.html')))
+    assert os.path.samefile(str(dest.join('same.html')), str(prev.join('same.html')))
+
+    # Changed, new or unrelated files are written
+    assert not write_file(str(dest.join('changed.html')), 'new\n',
+                          str(prev.join('changed.html')))
+    assert not write_file(str(dest.join('new.html')), 'new\n', str(prev.join('new.html')))
+    assert not write_file(str(dest.join('plain.html')), 'plain\n')
+    assert not os.path.samefile(str(dest.join('changed.html')),
+                                str(prev.join('changed.html')))
+    assert dest.join('changed.html').read() == 'new\n'
+    assert prev.join('changed.html').read() == 'old\n'
+    assert dest.join('new.html').read() == 'new\n'
+    assert dest.join('plain.html').read() == 'plain\n'
+
+def test_replace_symlink(tmpdir):
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    link = str(tmpdir.join('output'))
+
+    replace_symlink('a', link)
+    assert os.readlink(link) == 'a'
+    replace_symlink('b', link)
+    assert os.readlink(link) == 'b'
+    assert not os.path.lexists(link + '.new')
@@ -0,0 +1,105 @@
+"""
+Tests for searchindex.py - the client-side search index
+"""
+
+import json
+import os.path
+
+import fantail.searchindex
+from fantail.searchindex import *
+
+def test_tokenize():
+    terms = tokenize('<p>Hello, <em>World</em> &amp; a fantail_bird!</p>')
+    assert terms == {'hello', 'world', 'fantail', 'bird'}
+
+def test_delta_encoding():
+    ids = [0, 3, 4, 10]
+    assert delta_encode(ids) == [0, 3, 1, 6]
+    assert delta_decode(delta_encode(ids)) == ids
+    assert delta_encode([]) == []
+
+def test_shard_name():
+    assert shard_name('hello') == 'he'
+    assert shard_name('42') == '42'
+    assert shard_name('été') == '_c3a974'
+    assert shard_name('日本語') == '_e697a5e69cac'
+    assert shard_name('a日') == '_61e697a5'
+
+def test_write_index(tmpdir):
+    index = SearchIndex(str(tmpdir.join('cache', 'search.json')))
+    index.add_page('/', {'title': 'Home'}, '<p>Welcome home</p>')
+    index.add_page('/blog/hello/', [('title', 'Hello')], 'Welcome to my blog')
+    assert len(index) == 2
+
+    output = str(tmpdir.join('output'))
+    index.write(output)
+
+    with open(os.path.join(output, 'search', 'index.json')) as fp:
+        manifest = json.load(fp)
+    assert manifest['shards'] == ['bl', 'he', 'ho', 'my', 'to', 'we']
+    assert manifest['docs'] == {
+        '0': {'url': '/', 'title': 'Home'},
+        '1': {'url': '/blog/hello/', 'title': 'Hello'},
+    }
+
+    with open(os.path.join(output, 'search', 'terms', 'we.json')) as fp:
+        assert json.load(fp) == {'welcome': [0, 1]}
+
+def test_title_header_case(tmpdir):
+    index = SearchIndex(str(tmpdir.join('cache', 'search.json')))
+    index.add_page('/', [('Title', 'Home Page')], 'content')
+    assert 'home' in index.shards()['ho']
+
+    output = str(tmpdir.join('output'))
+    index.write(output)
+    with open(os.path.join(output, 'search', 'index.json')) as fp:
+        assert json.load(fp)['docs']['0']['title'] == 'Home Page'
+
+def test_incremental_update(tmpdir, monkeypatch):
+    cache = str(tmpdir.join('cache', 'search.json'))
+    index = SearchIndex(cache)
+    index.add_page('/', {'title': 'Home'}, 'first')
+    index.add_page('/a/', {'title': 'A'}, 'first')
+    index.add_page('/b/', {'title': 'B'}, 'first')
+    index.save_cache()
+    assert os.path.isfile(cache)
+
+    # Count the pages that are tokenised from here on
+    tokenized = []
+    def counting_tokenize(text):
+        tokenized.append(text)
+        return tokenize(text)
+    monkeypatch.setattr(fantail.searchindex, 'tokenize', counting_tokenize)
+
+    # Rebuild with /a/ removed, /b/ changed and /c/ added
+    index = SearchIndex(cache)
+    index.add_page('/', {'title': 'Home'}, 'first')
+    assert tokenized == []
+    index.add_page('/b/', {'title': 'B'}, 'second')
+    index.add_page('/c/', {'title': 'C'}, 'first')
+    assert sorted(tokenized) == ['B', 'C', 'first', 'second']
+    shards = index.shards()
+
+    # Unchanged pages keep their ids and new pages don't reuse any
+    assert delta_decode(shards['fi']['first']) == [0, 3]
+    assert delta_decode(shards['se']['second']) == [2]
+    assert 'ho' in shards
+
+    # The removed page (id 1) is gone from every posting list and the docs
+    for terms in shards.values():
+        for deltas in terms.values():
+            assert 1 not in delta_decode(deltas)
+    output = str(tmpdir.join('output'))
+    index.write(output)
+    with open(os.path.join(output, 'search', 'index.json')) as fp:
+        docs = json.load(fp)['docs']
+    assert sorted(docs) == ['0', '2', '3']
+    assert '/a/' not in [d['url'] for d in docs.values()]
+    index.save_cache()
+
+    # Remove the page with the highest id: after reloading from the cache a
+    # new page must still not be given its id
+    index = SearchIndex(cache)
+    index.add_page('/', {'title': 'Home'}, 'first')
+    index.add_page('/d/', {'title': 'D'}, 'first')
+    assert delta_decode(index.shards()['fi']['first']) == [0, 4]
@@ -2,9 +2,12 @@
 Tests for staticsite.py - the static site generator
 """
 
-import os.path
+import builtins
+import json
+import os
 import pytest
 
+import fantail.fileutils
 from fantail.staticsite import StaticSite
 
 def test_init(tmpdir, caplog):
@@ -43,3 +46,174 @@ def test_site_clean(tmpdir, caplog):
     # This should succeed now
     site.clean_site()
     assert 'Removed output directory from' in caplog.text()
+
+def test_site_rollback(tmpdir):
+    path = str(tmpdir.join('test-site'))
+    site = StaticSite(path)
+    site.init_site()
+    assert site.current_generation() is None
+
+    # Plain output directory, nothing to roll back to
+    with pytest.raises(SystemExit):
+        site.rollback_site()
+
+    for generation in (1, 2):
+        os.makedirs(os.path.join(site.generations_dir, str(generation)))
+    os.rmdir(site.output_dir)
+    os.symlink(os.path.join('generations', '2'), site.output_dir)
+    assert site.list_generations() == [1, 2]
+    assert site.current_generation() == 2
+
+    with pytest.raises(SystemExit):
+        site.rollback_site(generation=3)
+    site.rollback_site()
+    assert site.current_generation() == 1
+    with pytest.raises(SystemExit):
+        site.rollback_site()
+    site.rollback_site(generation=2)
+    assert site.current_generation() == 2
+
+    site.clean_site()
+    assert not os.path.lexists(site.output_dir)
+    assert not os.path.exists(site.generations_dir)
+
+@pytest.fixture
+def built_site(tmpdir, monkeypatch):
+    """
+    A new site with two pages that can be built without `tree` installed.
+    """
+    monkeypatch.setattr(StaticSite, '_log_finished', lambda self: None)
+    site = StaticSite(str(tmpdir.join('test-site')))
+    site.init_site()
+    write_page(site, 'index.txt', 'Home')
+    write_page(site, 'about.txt', 'About')
+    return site
+
+def write_page(site, name, content, headers='title: Page'):
+    with open(os.path.join(site.pages_dir, name), 'w') as fp:
+        fp.write(headers + '\n\n' + content + '\n')
+
+def generation_file(site, generation, *path):
+    return os.path.join(site.generations_dir, str(generation), *path)
+
+def test_publish_generations(built_site):
+    site = built_site
+    site.build_site()
+    assert not os.path.islink(site.output_dir)
+
+    # The plain output directory becomes generation 1
+    site.build_site(generations=2)
+    assert os.path.islink(site.output_dir)
+    assert site.list_generations() == [1, 2]
+    assert site.current_generation() == 2
+    assert os.path.samefile(generation_file(site, 1, 'index.html'),
+                            generation_file(site, 2, 'index.html'))
+
+    # Only changed pages are written, and older generations are untouched
+    write_page(site, 'index.txt', 'Home again')
+    site.build_site()
+    assert site.list_generations() == [2, 3]
+    assert site.current_generation() == 3
+    assert os.path.samefile(generation_file(site, 2, 'about', 'index.html'),
+                            generation_file(site, 3, 'about', 'index.html'))
+    assert not os.path.samefile(generation_file(site, 2, 'index.html'),
+                                generation_file(site, 3, 'index.html'))
+    with open(generation_file(site, 2, 'index.html')) as fp:
+        assert 'Home again' not in fp.read()
+    with open(os.path.join(site.output_dir, 'index.html')) as fp:
+        assert 'Home again' in fp.read()
+    assert [f for f in os.listdir(site.generations_dir) if f.startswith('.')] == []
+
+def test_publish_generations_keep_is_saved(built_site):
+    site = built_site
+    site.build_site(generations=4)
+    for i in range(5):
+        write_page(site, 'index.txt', 'Home {}'.format(i))
+        site.build_site()
+    assert site.saved_generations() == 4
+    assert site.list_generations() == [4, 5, 6, 7]
+
+def test_publish_generations_invalid_keep(built_site):
+    site = built_site
+    site.build_site(generations=2)
+    for keep in (0, -2):
+        with pytest.raises(SystemExit):
+            site.build_site(generations=keep)
+    assert site.list_generations() == [1, 2]
+    assert site.current_generation() == 2
+
+def test_prune_generations_keeps_current(built_site):
+    site = built_site
+    site.build_site(generations=3)
+    for i in range(2):
+        write_page(site, 'index.txt', 'Home {}'.format(i))
+        site.build_site()
+    assert site.list_generations() == [2, 3, 4]
+    site.rollback_site(generation=2)
+    site._prune_generations(1)
+    assert site.list_generations() == [2, 4]
+    assert site.current_generation() == 2
+
+def test_publish_generations_failed_build(built_site):
+    site = built_site
+
+    # A failed first publish leaves the plain output directory alone
+    write_page(site, 'broken.txt', 'Broken', headers='template: missing.html')
+    with pytest.raises(SystemExit):
+        site.build_site(generations=2)
+    assert not os.path.islink(site.output_dir)
+    assert not os.path.exists(site.generations_dir)
+
+    os.remove(os.path.join(site.pages_dir, 'broken.txt'))
+    site.build_site(generations=2)
+    write_page(site, 'broken.txt', 'Broken', headers='template: missing.html')
+    with pytest.raises(SystemExit):
+        site.build_site()
+    assert site.current_generation() == 2
+    assert sorted(os.listdir(site.generations_dir)) == ['1', '2', 'keep']
+
+def test_publish_generations_git_checkout(built_site):
+    site = built_site
+    os.makedirs(os.path.join(site.output_dir, '.git'))
+    with pytest.raises(SystemExit):
+        site.build_site(generations=2)
+    assert not os.path.islink(site.output_dir)
+    assert os.path.isdir(os.path.join(site.output_dir, '.git'))
+
+def test_build_search_index(built_site):
+    site = built_site
+    os.makedirs(os.path.join(site.pages_dir, 'blog'))
+    write_page(site, os.path.join('blog', 'hello-world.txt'), 'Hello', headers='Title: Hi')
+    site.build_site()
+
+    with open(os.path.join(site.output_dir, 'search', 'index.json')) as fp:
+        docs = json.load(fp)['docs']
+    assert sorted((d['url'], d['title']) for d in docs.values()) == [
+        ('/', 'Page'),
+        ('/about/', 'Page'),
+        ('/blog/hello-world/', 'Hi'),
+    ]
+
+def test_publish_generations_only_writes_changes(built_site, monkeypatch):
+    site = built_site
+    site.build_site(generations=2)
+
+    # Record every file opened for writing from here on
+    written = []
+    def spy_open(file, mode='r', *args, **kwargs):
+        if 'w' in mode:
+            written.append(os.path.relpath(file, site.generations_dir))
+        return builtins.open(file, mode, *args, **kwargs)
+    monkeypatch.setattr(fantail.fileutils, 'open', spy_open, raising=False)
+
+    # Change the text but keep the same terms, so the search index is unchanged
+    write_page(site, 'index.txt', 'Home home')
+    site.build_site()
+    assert len(written) == 1
+    assert written[0].endswith(os.path.join('', 'index.html'))
+    assert os.path.dirname(written[0]).startswith('.build-')
+
+    for path in (('about', 'index.html'), ('search', 'index.json'),
+                 ('search', 'terms', 'ho.json')):
+        assert os.path.samefile(generation_file(site, 2, *path),
+                                generation_file(site, 3, *path))